@@ -1,18 +1,78 @@
 from sqlalchemy import create_engine, exc, text
+from sqlalchemy.dialects.postgresql import ARRAY, REAL
 from sqlalchemy.engine import Engine
 from urllib.parse import urlparse, quote
 import datetime
 from typing import Any, Optional
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import requests
 import time
 
 
+# failure reason for lookups that returned no data
+NOT_FOUND = "not_found"
+# failure reason for ISRCs whose MBID is already stored or claimed by another ISRC in the same batch
+DUPLICATE_MBID = "duplicate_mbid"
+# reasons retried with the long backoff window, every other reason is treated as transient
+PERMANENT_REASONS = (NOT_FOUND, DUPLICATE_MBID)
+
+# (first delay, max delay) in seconds, the delay doubles for every failed attempt
+TRANSIENT_BACKOFF = (3600, 7 * 24 * 3600)
+NOT_FOUND_BACKOFF = (7 * 24 * 3600, 180 * 24 * 3600)
+
+
+# column -> (high-level classifier, label whose probability is stored)
+BINARY_CLASSIFIERS = {
+    "danceability": ("danceability", "danceable"),
+    "female": ("gender", "female"),
+    "instrumental": ("voice_instrumental", "instrumental"),
+    "bright": ("timbre", "bright"),
+    "tonal": ("tonal_atonal", "tonal"),
+    "mood_acoustic": ("mood_acoustic", "acoustic"),
+    "mood_aggressive": ("mood_aggressive", "aggressive"),
+    "mood_electronic": ("mood_electronic", "electronic"),
+    "mood_happy": ("mood_happy", "happy"),
+    "mood_party": ("mood_party", "party"),
+    "mood_relaxed": ("mood_relaxed", "relaxed"),
+    "mood_sad": ("mood_sad", "sad"),
+}
+
+# multi-class classifier -> class labels, in the order their probabilities are stored in <classifier>_probs
+MULTICLASS_CLASSIFIERS = {
+    "genre_dortmund": ["alternative", "blues", "electronic", "folkcountry", "funksoulrnb", "jazz", "pop", "raphiphop", "rock"],
+    "genre_electronic": ["ambient", "dnb", "house", "techno", "trance"],
+    "genre_rosamerica": ["cla", "dan", "hip", "jaz", "pop", "rhy", "roc", "spe"],
+    "genre_tzanetakis": ["blu", "cla", "cou", "dis", "hip", "jaz", "met", "pop", "reg", "roc"],
+    "ismir04_rhythm": ["ChaChaCha", "Jive", "Quickstep", "Rumba-American", "Rumba-International", "Rumba-Misc",
+                       "Samba", "Tango", "VienneseWaltz", "Waltz"],
+    "moods_mirex": ["Cluster1", "Cluster2", "Cluster3", "Cluster4", "Cluster5"],
+}
+
+# key name -> pitch class, same convention as Spotify (C = 0)
+PITCH_CLASSES = {
+    "C": 0, "C#": 1, "Db": 1, "D": 2, "D#": 3, "Eb": 3, "E": 4, "F": 5, "F#": 6, "Gb": 6,
+    "G": 7, "G#": 8, "Ab": 8, "A": 9, "A#": 10, "Bb": 10, "B": 11
+}
+
+# maximum number of MBIDs per bulk request to the AcousticBrainz API
+BULK_SIZE = 25
+
+
+def _backoff_window(reason: str) -> tuple[int, int]:
+    return NOT_FOUND_BACKOFF if reason in PERMANENT_REASONS else TRANSIENT_BACKOFF
+
+
+def _request_failure_reason(e: requests.exceptions.RequestException) -> str:
+    return "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection_error"
+
+
 class AcousticBrainzETL:
-    def __init__(self, db_loc: str, app_name: str, email: str):
+    def __init__(self, db_loc: str, app_name: str, email: str, max_isrcs_per_run: int = 500):
         self.db_loc = db_loc
         self.engine = None
+        self.max_isrcs_per_run = max_isrcs_per_run
         self.app_name = app_name
         self.email = email
         self.user_agent = f"{app_name} ({email})"
@@ -27,59 +87,92 @@ class AcousticBrainzETL:
         return self.engine
 
     def _get_missing_isrc(self) -> list[str]:
-        """ Get ISRCs of songs where data is needed to be fetched. """
+        """ Get ISRCs of songs where data is needed to be fetched, limited to the per-run request budget.
+
+        Never attempted ISRCs come first, then failed ones whose backoff window has passed,
+        transient failures before lookups that found nothing, and fewest attempts first.
+        """
         with self.engine.begin() as conn:
             query = text(""" 
-                SELECT DISTINCT s.isrc 
-                FROM song_data s
+                SELECT s.isrc
+                FROM (SELECT DISTINCT isrc FROM song_data WHERE isrc IS NOT NULL) s
                 LEFT JOIN acousticbrainz_data a on s.isrc = a.isrc
                 LEFT JOIN failed_isrcs f on s.isrc = f.isrc
-                LEFT JOIN invalid_mbids m on s.isrc = m.isrc
-                WHERE s.isrc IS NOT NULL
-                AND f.isrc IS NULL
-                AND m.isrc IS NULL
-                AND a.isrc IS NULL
+                LEFT JOIN (
+                    SELECT isrc, MAX(next_attempt) AS next_attempt, MAX(attempts) AS attempts, MIN(reason) AS reason
+                    FROM invalid_mbids
+                    GROUP BY isrc
+                ) m on s.isrc = m.isrc
+                WHERE a.isrc IS NULL
+                AND (f.isrc IS NULL OR f.next_attempt <= CURRENT_TIMESTAMP)
+                AND (m.isrc IS NULL OR m.next_attempt <= CURRENT_TIMESTAMP)
+                ORDER BY
+                    (f.isrc IS NOT NULL OR m.isrc IS NOT NULL),
+                    (COALESCE(f.reason, m.reason, '') = ANY(:permanent_reasons)),
+                    COALESCE(f.attempts, 0) + COALESCE(m.attempts, 0)
+                LIMIT :max_isrcs
                 """)
-            res = conn.execute(query)
-            new_isrc = {row.isrc for row in res.fetchall()}
-            return list(new_isrc)
+            res = conn.execute(query, {"permanent_reasons": list(PERMANENT_REASONS), "max_isrcs": self.max_isrcs_per_run})
+            return [row.isrc for row in res.fetchall()]
 
-    def _isrc_to_mbid(self, isrc_list: list[str]) -> tuple[list[Optional[str]], list[str], dict[str, str]]:
+    def _isrc_to_mbid(self, isrc_list: list[str]) -> tuple[list[Optional[str]], dict[str, str], dict[str, str]]:
 
         mbid_list = []
-        failed_conversion_list = []
+        failed_conversion_list = {}  # isrc -> failure reason
         mbid_to_isrc = {}
         print(f"starting process of fetching Musicbrainz IDs using ISRC. should take approximately {len(isrc_list)} seconds.")
         for isrc in tqdm(isrc_list, desc="parsing ISRCs"):
             url = f"https://musicbrainz.org/ws/2/recording/?query=isrc:{quote(isrc)}&fmt=json"
             while True:
-                response = requests.get(url, headers=self.headers, timeout=10)
+                try:
+                    response = requests.get(url, headers=self.headers, timeout=10)
+                except requests.exceptions.RequestException as e:
+                    failed_conversion_list[isrc] = _request_failure_reason(e)
+                    time.sleep(1)
+                    break
                 time.sleep(1)
                 if response.status_code == 200:
                     datafile = response.json()
                     if datafile.get("recordings"):
                         # print(f"Successfully fetched mbid for ISRC {isrc}")
                         mbid = datafile["recordings"][0]["id"]
-                        mbid_list.append(mbid)
-                        mbid_to_isrc[mbid] = isrc
+                        if mbid in mbid_to_isrc:
+                            # the first ISRC keeps the MBID, data is only fetched and stored once
+                            failed_conversion_list[isrc] = DUPLICATE_MBID
+                        else:
+                            mbid_list.append(mbid)
+                            mbid_to_isrc[mbid] = isrc
                     else:
                         # print(f"No mbid data available for irsc {isrc}.")
-                        failed_conversion_list.append(isrc)
+                        failed_conversion_list[isrc] = NOT_FOUND
                     break
                 if response.status_code == 429:
                     print(f"Rate limit exceeded. Pausing until extraction can be resumed.")
                     time.sleep(1)
                 else:
                     print(f"Failed fetching mbid. Status code {response.status_code}.")
-                    failed_conversion_list.append(isrc)
+                    failed_conversion_list[isrc] = f"http_{response.status_code}"
                     break
 
         print(f"Process finished. For {len(isrc_list)} ISRCs, MBIDs were found for {len(mbid_list)}, and the extraction failed for {len(failed_conversion_list)}.")
         return mbid_list, failed_conversion_list, mbid_to_isrc
 
-    def _extract(self, mbid_list: list[str]) -> tuple[dict[str, dict], list[str]]:
+    def _drop_known_mbids(self, mbid_list: list[str], failed_isrcs: dict[str, str], mbid_to_isrc: dict[str, str]) -> list[str]:
+        """ Drop MBIDs already stored for another ISRC, recording those ISRCs as duplicates so they leave the top retry tier. """
+        with self.engine.begin() as conn:
+            query = text("""
+                SELECT mbid
+                FROM acousticbrainz_data
+                WHERE mbid = ANY(:mbids)
+            """)
+            known_mbids = {row.mbid for row in conn.execute(query, {"mbids": mbid_list})}
+        for mbid in known_mbids:
+            failed_isrcs[mbid_to_isrc.pop(mbid)] = DUPLICATE_MBID
+        return [mbid for mbid in mbid_list if mbid not in known_mbids]
+
+    def _extract(self, mbid_list: list[str]) -> tuple[dict[str, dict], dict[str, str]]:
         ab_data = {}
-        invalid_mbids = []
+        invalid_mbids = {}  # mbid -> failure reason
         print("Acousticbrainz data extraction initiated.")
         for mbid in mbid_list:
             if not mbid:
@@ -88,7 +181,11 @@ class AcousticBrainzETL:
             url = f"https://acousticbrainz.org/api/v1/{mbid}/high-level"
 
             while True:
-                res = requests.get(url, headers=self.headers, timeout=10)
+                try:
+                    res = requests.get(url, headers=self.headers, timeout=10)
+                except requests.exceptions.RequestException as e:
+                    invalid_mbids[mbid] = _request_failure_reason(e)
+                    break
                 if res.status_code == 200:
                     # print(f"Success fetching high-level data for mbid {mbid}.")
                     ab_data[mbid] = res.json()
@@ -98,63 +195,175 @@ class AcousticBrainzETL:
                     time.sleep(10)
                 elif res.status_code == 404:
                     # print(f"No acoustic data found at {url_high}.")
-                    invalid_mbids.append(mbid)
+                    invalid_mbids[mbid] = NOT_FOUND
                     break
                 else:
                     # print(f"Failed fetching high-level data. Status code {res_high.status_code}")
+                    invalid_mbids[mbid] = f"http_{res.status_code}"
                     break
 
-        invalid_mbids = list(set(invalid_mbids))
         print(f"Acousticbrainz data extraction finished. Out of {len(mbid_list)} MBIDs, data was found for {len(ab_data)}. {len(invalid_mbids)} invalid MBIDs.")
         return ab_data, invalid_mbids
 
-    def _transform(self, raw_data: dict[str, Any], mbids: list[Optional[str]], failed_mbids: list[str], mbid_isrc_mapping: dict[str, str]) -> pd.DataFrame:
-        output_data = []
+    def _extract_lowlevel(self, mbid_list: list[str]) -> tuple[dict[str, dict], set[str]]:
+        """ Fetch BPM and key using the bulk low-level endpoint. Missing low-level data does not fail the MBID.
 
-        for mbid in mbids:
-            if not mbid:
-                continue
-            if mbid in failed_mbids:
-                continue
-            isrc = mbid_isrc_mapping.get(mbid)
-            if not isrc:
-                print(f"Error with fetching isrc using MBID {mbid}.")
-                continue
+        Only bpm, key_key and key_scale are kept from each document, the rest (mfcc, hpcp, ...) is dropped right away.
+        Also returns the MBIDs whose request succeeded, with or without data; the others are retried on later runs.
+        """
+        lowlevel_data = {}
+        checked_mbids = set()
+        for i in range(0, len(mbid_list), BULK_SIZE):
+            chunk = mbid_list[i:i + BULK_SIZE]
+            url = f"https://acousticbrainz.org/api/v1/low-level?recording_ids={';'.join(chunk)}"
+            while True:
+                try:
+                    res = requests.get(url, headers=self.headers, timeout=30)
+                except requests.exceptions.RequestException as e:
+                    print(f"Failed fetching low-level data: {e}")
+                    break
+                if res.status_code == 200:
+                    datafile = res.json()
+                    checked_mbids.update(chunk)
+                    for mbid in chunk:
+                        doc = datafile.get(mbid, {}).get("0")
+                        if doc:
+                            tonal = doc.get("tonal", {})
+                            lowlevel_data[mbid] = {
+                                "bpm": doc.get("rhythm", {}).get("bpm"),
+                                "key_key": tonal.get("key_key"),
+                                "key_scale": tonal.get("key_scale")
+                            }
+                    break
+                elif res.status_code == 429:
+                    time.sleep(10)
+                else:
+                    print(f"Failed fetching low-level data. Status code {res.status_code}.")
+                    break
+        return lowlevel_data, checked_mbids
 
-            ab_data = raw_data.get(mbid, {}).get("highlevel", {})
-            features = {
-                "isrc": isrc,
-                "mbid": mbid,
-                "danceability": ab_data.get("danceability", {}).get("value"),
-                "instrumentality": ab_data.get("voice_instrumental", {}).get("value"),
-                "instrumentality_prob": ab_data.get("voice_instrumental", {}).get("probability"),
-                "gender": ab_data.get("gender", {}).get("value"),
-                "gender_prob": ab_data.get("gender", {}).get("probability"),
-                "timbre": ab_data.get("timbre", {}).get("value"),
-                "tonality": ab_data.get("tonal_atonal", {}).get("value")
-            }
-            output_data.append(features)
-        df = pd.DataFrame(output_data)
-        return df
+    def _lowlevel_features(self, lowlevel_data: dict[str, dict], checked_mbids: set[str], mbids: list[str]) -> pd.DataFrame:
+        """ bpm, key, mode and lowlevel_checked columns for the given MBIDs, in the same order. """
+        return pd.DataFrame({
+            "bpm": lowlevel["bpm"].astype("float32"),
+            "key": lowlevel["key_key"].map(PITCH_CLASSES).astype("Int16"),
+            "mode": lowlevel["key_scale"].map({"major": 1, "minor": 0}).astype("Int16"),
+            "lowlevel_checked": [mbid in checked_mbids for mbid in mbids]
+        })
+
+    def _retry_lowlevel(self) -> None:
+        """ Fetch BPM and key again for stored rows whose low-level request failed on an earlier run. """
+        with self.engine.begin() as conn:
+            query = text("""
+                SELECT mbid
+                FROM acousticbrainz_data
+                WHERE NOT lowlevel_checked
+                LIMIT :max_mbids
+            """)
+            mbids = [row.mbid for row in conn.execute(query, {"max_mbids": self.max_isrcs_per_run})]
+        if not mbids:
+            return
+        lowlevel_data, checked_mbids = self._extract_lowlevel(mbids)
+        mbids = [mbid for mbid in mbids if mbid in checked_mbids]
+        if not mbids:
+            return
+        features = self._lowlevel_features(lowlevel_data, checked_mbids, mbids)
+        rows = [{
+            "mbid": mbid,
+            "bpm": None if pd.isna(row.bpm) else float(row.bpm),
+            "key": None if pd.isna(row.key) else int(row.key),
+            "mode": None if pd.isna(row.mode) else int(row.mode),
+            "lowlevel_checked": True
+        } for mbid, row in zip(mbids, features.itertuples())]
+        with self.engine.begin() as conn:
+            query = text("""
+                UPDATE acousticbrainz_data
+                SET bpm = :bpm, key = :key, mode = :mode, lowlevel_checked = :lowlevel_checked,
+                    load_seq = nextval(pg_get_serial_sequence('acousticbrainz_data', 'load_seq'))
+                WHERE mbid = :mbid
+            """)
+            conn.execute(query, rows)
+        print(f"Low-level data retried for {len(mbids)} MBIDs.")
+
+    def _transform(self, raw_data: dict[str, Any], lowlevel_data: dict[str, Any], checked_mbids: set[str], mbids: list[Optional[str]],
+                   failed_mbids: dict[str, str], mbid_isrc_mapping: dict[str, str]) -> pd.DataFrame:
+        mbids = [mbid for mbid in mbids if mbid and mbid not in failed_mbids and mbid in raw_data]
+        missing_isrc = [mbid for mbid in mbids if not mbid_isrc_mapping.get(mbid)]
+        for mbid in missing_isrc:
+            print(f"Error with fetching isrc using MBID {mbid}.")
+        mbids = [mbid for mbid in mbids if mbid not in missing_isrc]
+        if not mbids:
+            return pd.DataFrame()
+
+        # flatten all high-level documents at once, e.g. mood_happy.all.happy
+        highlevel = pd.json_normalize([raw_data[mbid].get("highlevel", {}) for mbid in mbids])
+
+        df = pd.DataFrame({
+            "isrc": [mbid_isrc_mapping[mbid] for mbid in mbids],
+            "mbid": mbids
+        })
+        for column, (classifier, label) in BINARY_CLASSIFIERS.items():
+            df[column] = highlevel.reindex(columns=[f"{classifier}.all.{label}"]).iloc[:, 0].astype("float32")
+
+        for classifier, labels in MULTICLASS_CLASSIFIERS.items():
+            df[classifier] = highlevel.reindex(columns=[f"{classifier}.value"]).iloc[:, 0]
+            probs = highlevel.reindex(columns=[f"{classifier}.all.{label}" for label in labels]).to_numpy(dtype="float32")
+            has_probs = ~np.isnan(probs).all(axis=1)
+            df[f"{classifier}_probs"] = [row.tolist() if ok else None for row, ok in zip(probs, has_probs)]
+
+        return pd.concat([df, self._lowlevel_features(lowlevel_data, checked_mbids, mbids)], axis=1)
 
     def _initialize_database(self) -> None:
         """ Initialise tables if not already existing. """
 
         with self.engine.begin() as conn:
-            query1 = text("""
+            # tables from before the typed schema stored labels as TEXT, keep them aside and refetch
+            query_legacy = text("""
+                SELECT data_type
+                FROM information_schema.columns
+                WHERE table_name = 'acousticbrainz_data'
+                AND column_name = 'danceability'
+            """)
+            if conn.execute(query_legacy).scalar() == "text":
+                conn.execute(text("ALTER TABLE acousticbrainz_data RENAME TO acousticbrainz_data_legacy"))
+                conn.execute(text("ALTER TABLE acousticbrainz_data_legacy RENAME CONSTRAINT acousticbrainz_data_pkey TO acousticbrainz_data_legacy_pkey"))
+                conn.execute(text("ALTER TABLE acousticbrainz_data_legacy RENAME CONSTRAINT acousticbrainz_data_mbid_key TO acousticbrainz_data_legacy_mbid_key"))
+                print("Moved TEXT-labelled acousticbrainz_data to acousticbrainz_data_legacy, features will be refetched.")
+
+            multiclass_columns = "\n".join(
+                f"                    {classifier} TEXT,  -- most probable class\n"
+                f"                    {classifier}_probs REAL[],  -- P({', '.join(labels)})"
+                for classifier, labels in MULTICLASS_CLASSIFIERS.items())
+            query1 = text(f"""
                 CREATE TABLE IF NOT EXISTS acousticbrainz_data (
                     isrc TEXT PRIMARY KEY NOT NULL,     -- International Standard Recording Code
                     mbid TEXT UNIQUE,                   -- MusicBrainz ID, UUID format
-                    danceability TEXT,                  -- danceable/not danceable
-                    instrumentality TEXT,               -- instrumental/voice
-                    instrumentality_prob REAL,          -- probability of being instrumental/voice
-                    gender TEXT,                        -- male/female
-                    gender_prob REAL,                   -- probability of male/female
-                    timbre TEXT,                        -- bright/dark
-                    tonality TEXT                       -- tonal/atonal
+                    danceability REAL,                  -- P(danceable)
+                    female REAL,                        -- P(female voice)
+                    instrumental REAL,                  -- P(instrumental)
+                    bright REAL,                        -- P(bright timbre)
+                    tonal REAL,                         -- P(tonal)
+                    mood_acoustic REAL,                 -- P(acoustic)
+                    mood_aggressive REAL,               -- P(aggressive)
+                    mood_electronic REAL,               -- P(electronic)
+                    mood_happy REAL,                    -- P(happy)
+                    mood_party REAL,                    -- P(party)
+                    mood_relaxed REAL,                  -- P(relaxed)
+                    mood_sad REAL,                      -- P(sad)
+{multiclass_columns}
+                    bpm REAL,                           -- beats per minute
+                    key SMALLINT,                       -- pitch class, C = 0
+                    mode SMALLINT,                      -- 1 major, 0 minor
+                    lowlevel_checked BOOLEAN DEFAULT FALSE, -- low-level request succeeded, FALSE is retried
+                    load_seq BIGSERIAL                  -- increases on every insert or feature update, read by similarity_index
                         )
             """)
             conn.execute(query1)
+            conn.execute(text("ALTER TABLE acousticbrainz_data ADD COLUMN IF NOT EXISTS lowlevel_checked BOOLEAN DEFAULT FALSE"))
+            conn.execute(text("ALTER TABLE acousticbrainz_data ADD COLUMN IF NOT EXISTS load_seq BIGSERIAL"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS acousticbrainz_data_load_seq_idx ON acousticbrainz_data (load_seq)"))
+            # rows stored before the flag existed are only retried when they actually lack low-level data
+            conn.execute(text("UPDATE acousticbrainz_data SET lowlevel_checked = TRUE WHERE NOT lowlevel_checked AND bpm IS NOT NULL"))
             query2 = text(""" CREATE TABLE IF NOT EXISTS failed_isrcs(
                         isrc TEXT PRIMARY KEY,                             -- International Standard Recording Code
                         last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP   -- timestamp of fetching attempt
@@ -169,7 +378,40 @@ class AcousticBrainzETL:
             """)
             conn.execute(query3)
 
-    def _load(self, df: pd.DataFrame, failed_mbids: list[str], failed_isrcs: list[str], mbid_isrc_mapping: dict[str, str]) -> None:
+            # retry queue columns, added to tables created before retries were scheduled
+            for table in ("failed_isrcs", "invalid_mbids"):
+                conn.execute(text(f"""
+                    ALTER TABLE {table}
+                        ADD COLUMN IF NOT EXISTS reason TEXT DEFAULT '{NOT_FOUND}',   -- not_found, duplicate_mbid, timeout, http_<status>, ...
+                        ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 1,          -- number of failed attempts
+                        ADD COLUMN IF NOT EXISTS next_attempt TIMESTAMP               -- earliest time of next retry
+                """))
+                conn.execute(text(f"""
+                    UPDATE {table}
+                    SET next_attempt = last_attempt + make_interval(secs => :first_delay)
+                    WHERE next_attempt IS NULL
+                """), {"first_delay": NOT_FOUND_BACKOFF[0]})
+
+    def _record_failures(self, conn, table: str, key: str, failures: list[dict[str, str]]) -> None:
+        """ Upsert failures into a retry table, doubling the backoff window for each repeated failure. """
+        query = text(f"""
+            INSERT INTO {table} ({key}, {'isrc, ' if key != 'isrc' else ''}reason, attempts, last_attempt, next_attempt)
+            VALUES (:{key}, {':isrc, ' if key != 'isrc' else ''}:reason, 1, CURRENT_TIMESTAMP,
+                    CURRENT_TIMESTAMP + make_interval(secs => :first_delay))
+            ON CONFLICT ({key}) DO UPDATE SET
+                reason = EXCLUDED.reason,
+                attempts = {table}.attempts + 1,
+                last_attempt = EXCLUDED.last_attempt,
+                next_attempt = EXCLUDED.last_attempt
+                    + make_interval(secs => LEAST(:first_delay * POWER(2, {table}.attempts), :max_delay))
+        """)
+        params = []
+        for failure in failures:
+            first_delay, max_delay = _backoff_window(failure["reason"])
+            params.append({**failure, "first_delay": first_delay, "max_delay": max_delay})
+        conn.execute(query, params)
+
+    def _load(self, df: pd.DataFrame, failed_mbids: dict[str, str], failed_isrcs: dict[str, str], mbid_isrc_mapping: dict[str, str]) -> None:
         """Load processed data into database."""
 
         try:
@@ -186,33 +428,38 @@ class AcousticBrainzETL:
                     if new_df.empty:
                         print("DataFrame is empty after filtering, no data to upload.")
                     else:
-                        new_df.to_sql('acousticbrainz_data', con=conn, index=False, if_exists='append')
+                        new_df.to_sql('acousticbrainz_data', con=conn, index=False, if_exists='append',
+                                      dtype={f"{classifier}_probs": ARRAY(REAL) for classifier in MULTICLASS_CLASSIFIERS})
+
+                    # successful retries leave the retry queue
+                    loaded_isrcs = list(df['isrc'])
+                    conn.execute(text("DELETE FROM invalid_mbids WHERE isrc = ANY(:isrcs)"), {"isrcs": loaded_isrcs})
+
+                # ISRCs that resolved to an MBID no longer need their ISRC lookup retried
+                converted_isrcs = list(mbid_isrc_mapping.values())
+                if converted_isrcs:
+                    conn.execute(text("DELETE FROM failed_isrcs WHERE isrc = ANY(:isrcs)"), {"isrcs": converted_isrcs})
 
                 # failed ISRCs
                 if failed_isrcs:
-                    isrc_df = pd.DataFrame({
-                        'isrc': failed_isrcs,
-                        'last_attempt': pd.Timestamp.utcnow()
-                    })
-                    isrc_df.to_sql('failed_isrcs', con=conn, index=False, if_exists='append')
-                    print(f"{len(isrc_df)} failed ISRCs uploaded to database.")
+                    isrc_data = [{'isrc': isrc, 'reason': reason} for isrc, reason in failed_isrcs.items()]
+                    self._record_failures(conn, 'failed_isrcs', 'isrc', isrc_data)
+                    print(f"{len(isrc_data)} failed ISRCs scheduled for retry.")
 
                 # failed MBIDs
                 if failed_mbids:
                     mbid_data = []
-                    for mbid in failed_mbids:
+                    for mbid, reason in failed_mbids.items():
                         if mbid in mbid_isrc_mapping:
-                            isrc = mbid_isrc_mapping.get(mbid)
                             mbid_data.append({
                                 'mbid': mbid,
-                                'isrc': isrc,
-                                'last_attempt': pd.Timestamp.utcnow()
+                                'isrc': mbid_isrc_mapping.get(mbid),
+                                'reason': reason
                             })
 
                     if mbid_data:
-                        mbid_df = pd.DataFrame(mbid_data)
-                        mbid_df.to_sql('invalid_mbids', con=conn, index=False, if_exists='append')
-                        print(f"{len(mbid_df)} failed MBIDs uploaded to database.")
+                        self._record_failures(conn, 'invalid_mbids', 'mbid', mbid_data)
+                        print(f"{len(mbid_data)} failed MBIDs scheduled for retry.")
 
         except Exception as e:
             print(f"Failed to upload to database. Error: {e}")
@@ -222,13 +469,16 @@ class AcousticBrainzETL:
         try:
             self.engine = self._get_engine()
             self._initialize_database()
+            self._retry_lowlevel()
             isrc = self._get_missing_isrc()
             if not isrc:
                 print("No new records to add.")
                 return
             mbids, failed_isrcs, mbid_isrc_mapping = self._isrc_to_mbid(isrc)
+            mbids = self._drop_known_mbids(mbids, failed_isrcs, mbid_isrc_mapping)
             raw_data, failed_mbids = self._extract(mbids)
-            processed_data = self._transform(raw_data, mbids, failed_mbids, mbid_isrc_mapping)
+            lowlevel_data, checked_mbids = self._extract_lowlevel(list(raw_data))
+            processed_data = self._transform(raw_data, lowlevel_data, checked_mbids, mbids, failed_mbids, mbid_isrc_mapping)
             self._load(processed_data, failed_mbids, failed_isrcs, mbid_isrc_mapping)
         except Exception as e:
             print(f"ETL pipeline failed: {e}")
@@ -237,6 +487,6 @@ class AcousticBrainzETL:
             self.engine.dispose()
 
 
-def run(db_loc: str, app_name: str, email: str) -> None:
-    etl = AcousticBrainzETL(db_loc=db_loc, app_name=app_name, email=email)
+def run(db_loc: str, app_name: str, email: str, max_isrcs_per_run: int = 500) -> None:
+    etl = AcousticBrainzETL(db_loc=db_loc, app_name=app_name, email=email, max_isrcs_per_run=max_isrcs_per_run)
     etl.run()
@@ -1,8 +1,10 @@
 import spotify_etl
 import ab_etl
 import sql_to_excel
+import similarity_index
 import visualizer
 import json
+import os
 
 
 # DATABASE_LOCATION = "sqlite:///data/my_tracks.sqlite"
@@ -32,6 +34,14 @@ def load_db_config(config_path='pg_config.json'):
         print(f"Database config file not found at {config_path}.")
 
 
+def load_spotify_users(users_path='spotify_users.txt') -> list[str]:
+    """ User IDs to ingest, one per line. Empty if the file is missing, i.e. single-user mode. """
+    if not os.path.exists(users_path):
+        return []
+    with open(users_path, 'r') as f:
+        return [line.strip() for line in f.read().splitlines() if line.strip()]
+
+
 if __name__ == "__main__":
     db_loc = load_db_config()
     while True:
@@ -49,7 +59,11 @@ if __name__ == "__main__":
             c_id = lines[0]
             c_secret = lines[1]
             r_uri = lines[2]
-        spotify_etl.run(db_loc=db_loc, client_id=c_id, client_secret=c_secret, redirect_uri=r_uri)
+        user_ids = load_spotify_users()
+        if user_ids:
+            spotify_etl.run_many(db_loc=db_loc, client_id=c_id, client_secret=c_secret, redirect_uri=r_uri, user_ids=user_ids)
+        else:
+            spotify_etl.run(db_loc=db_loc, client_id=c_id, client_secret=c_secret, redirect_uri=r_uri)
 
         # run Acousticbrainz extraction
         with open("musicbrainz_config.txt", "r") as file:
@@ -58,6 +72,9 @@ if __name__ == "__main__":
             email = lines[1]
         ab_etl.run(db_loc=db_loc, app_name=app_name, email=email)
 
+        # add newly enriched tracks to the similarity index
+        similarity_index.run(db_loc=db_loc)
+
     while True:
         ans2 = input("Do you want to create excel-tables using the data available in the database? Answer with Yes/y or No/n: ").upper()
 
@@ -0,0 +1,132 @@
+from sqlalchemy import text
+from typing import Optional
+import pandas as pd
+
+
+class Sessionizer:
+    """ Groups plays into listening sessions, persisted per user in the sessions table.
+
+    A new session starts when the idle time between the expected end of a track (played_at + duration)
+    and the next play exceeds gap_minutes. A track counts as skipped when the next play comes before
+    skip_ratio of its duration has passed. Only new plays are processed, extending the user's last session.
+    """
+
+    def __init__(self, gap_minutes: int = 30, skip_ratio: float = 0.8):
+        self.gap_minutes = gap_minutes
+        self.skip_ratio = skip_ratio
+
+    def initialize(self, conn) -> None:
+        """ Initialise the sessions table if not already existing. """
+        query = text("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id TEXT NOT NULL,
+                session_start TIMESTAMPTZ NOT NULL,     -- played_at of the first play
+                session_end TIMESTAMPTZ,                -- played_at + duration of the last play
+                session_length_sec INTEGER,             -- session_end - session_start
+                listened_sec INTEGER,                   -- time actually listened, skipped tracks count until the next play
+                plays INTEGER,
+                skips INTEGER,
+                last_played_at TIMESTAMPTZ,             -- played_at of the last play, used when extending the session
+                last_duration_sec INTEGER,              -- duration of the last play, used when extending the session
+                PRIMARY KEY (user_id, session_start)
+            )
+        """)
+        conn.execute(query)
+
+    def _last_session(self, conn, user_id: str) -> Optional[dict]:
+        query = text("""
+            SELECT *
+            FROM sessions
+            WHERE user_id = :user_id
+            ORDER BY session_start DESC
+            LIMIT 1
+        """)
+        row = conn.execute(query, {"user_id": user_id}).mappings().first()
+        return dict(row) if row else None
+
+    def _user_history(self, conn, user_id: str) -> pd.DataFrame:
+        query = text("""
+            SELECT p.played_at, s.duration_sec
+            FROM plays p
+            LEFT JOIN song_data s ON p.track_id = s.track_id
+            WHERE p.user_id = :user_id
+        """)
+        return pd.read_sql(query, conn, params={"user_id": user_id})
+
+    def update(self, conn, user_id: str, new_plays: pd.DataFrame) -> int:
+        """ Sessionise newly inserted plays (played_at, duration_sec) for a user. Returns the number of sessions written.
+
+        When the user has no sessions yet, their whole play history is sessionised instead.
+        """
+        last_session = self._last_session(conn, user_id)
+        plays = new_plays[['played_at', 'duration_sec']] if last_session else self._user_history(conn, user_id)
+        if plays.empty:
+            return 0
+        plays = plays.assign(played_at=pd.to_datetime(plays['played_at'], format="ISO8601", utc=True),
+                             plays=1, carried=False)
+
+        # the last play of the open session goes first, so new plays can extend that session
+        if last_session:
+            carried = pd.DataFrame({
+                'played_at': [pd.Timestamp(last_session['last_played_at']).tz_convert("UTC")],
+                'duration_sec': [last_session['last_duration_sec']],
+                'plays': [0],
+                'carried': [True]
+            })
+            plays = pd.concat([carried, plays], ignore_index=True)
+        plays = plays.sort_values('played_at', kind="stable").reset_index(drop=True)
+        plays['duration_sec'] = plays['duration_sec'].fillna(0)
+
+        delta_sec = (plays['played_at'].shift(-1) - plays['played_at']).dt.total_seconds()
+        idle_sec = delta_sec - plays['duration_sec']
+        ends_session = (idle_sec > self.gap_minutes * 60) | delta_sec.isna()
+        plays['session'] = ends_session.shift(1, fill_value=False).cumsum()
+        plays['skips'] = (~ends_session & (delta_sec < self.skip_ratio * plays['duration_sec'])).astype(int)
+        plays['listened_sec'] = plays['duration_sec'].where(ends_session, delta_sec.clip(upper=plays['duration_sec']))
+        # the carried play was counted with its full duration when its session was last written
+        plays.loc[plays['carried'], 'listened_sec'] -= plays.loc[plays['carried'], 'duration_sec']
+
+        sessions = plays.groupby('session').agg(
+            session_start=('played_at', 'first'),
+            last_played_at=('played_at', 'last'),
+            last_duration_sec=('duration_sec', 'last'),
+            listened_sec=('listened_sec', 'sum'),
+            plays=('plays', 'sum'),
+            skips=('skips', 'sum'),
+            extends=('carried', 'any')
+        )
+        if last_session:
+            extended = sessions['extends']
+            sessions.loc[extended, 'session_start'] = pd.Timestamp(last_session['session_start']).tz_convert("UTC")
+            for column in ('listened_sec', 'plays', 'skips'):
+                sessions.loc[extended, column] += last_session[column]
+        sessions['session_end'] = sessions['last_played_at'] + pd.to_timedelta(sessions['last_duration_sec'], unit="s")
+        sessions['session_length_sec'] = (sessions['session_end'] - sessions['session_start']).dt.total_seconds()
+
+        query = text("""
+            INSERT INTO sessions (user_id, session_start, session_end, session_length_sec, listened_sec,
+                                  plays, skips, last_played_at, last_duration_sec)
+            VALUES (:user_id, :session_start, :session_end, :session_length_sec, :listened_sec,
+                    :plays, :skips, :last_played_at, :last_duration_sec)
+            ON CONFLICT (user_id, session_start) DO UPDATE SET
+                session_end = EXCLUDED.session_end,
+                session_length_sec = EXCLUDED.session_length_sec,
+                listened_sec = EXCLUDED.listened_sec,
+                plays = EXCLUDED.plays,
+                skips = EXCLUDED.skips,
+                last_played_at = EXCLUDED.last_played_at,
+                last_duration_sec = EXCLUDED.last_duration_sec
+        """)
+        rows = [{
+            'user_id': user_id,
+            'session_start': row.session_start.to_pydatetime(),
+            'session_end': row.session_end.to_pydatetime(),
+            'session_length_sec': int(row.session_length_sec),
+            'listened_sec': int(row.listened_sec),
+            'plays': int(row.plays),
+            'skips': int(row.skips),
+            'last_played_at': row.last_played_at.to_pydatetime(),
+            'last_duration_sec': int(row.last_duration_sec)
+        } for row in sessions.itertuples()]
+        conn.execute(query, rows)
+        return len(rows)
@@ -0,0 +1,297 @@
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from typing import Optional
+import numpy as np
+import pandas as pd
+import json
+import os
+from ab_etl import BINARY_CLASSIFIERS, MULTICLASS_CLASSIFIERS
+
+
+# BPM is scaled into roughly the same 0-1 range as the probabilities
+BPM_SCALE = 250.0
+
+FEATURE_DIM = len(BINARY_CLASSIFIERS) + sum(len(labels) for labels in MULTICLASS_CLASSIFIERS.values()) + 1
+
+# rows per block when scanning the memory-mapped feature file
+SCAN_BLOCK = 1 << 18
+
+# rows per chunk when assigning vectors to centroids, bounds the rows x n_lists distance matrix (~32 MB at 1024 lists)
+ASSIGN_CHUNK = 1 << 13
+
+
+def _feature_matrix(df: pd.DataFrame) -> np.ndarray:
+    """ Build float32 feature vectors from acousticbrainz_data rows. Missing values become uninformative defaults. """
+    blocks = [df[list(BINARY_CLASSIFIERS)].to_numpy(dtype="float32", na_value=0.5)]
+    for classifier, labels in MULTICLASS_CLASSIFIERS.items():
+        uniform = [1 / len(labels)] * len(labels)
+        probs = [p if isinstance(p, (list, tuple)) and len(p) == len(labels) else uniform for p in df[f"{classifier}_probs"]]
+        blocks.append(np.asarray(probs, dtype="float32").reshape(len(df), len(labels)))
+    bpm = df["bpm"].to_numpy(dtype="float32", na_value=BPM_SCALE / 2) / BPM_SCALE
+    blocks.append(np.clip(bpm, 0, 1).reshape(-1, 1))
+    return np.nan_to_num(np.hstack(blocks), nan=0.5)
+
+
+class SimilarityIndex:
+    """ k-nearest-neighbour index over acoustic features of the tracks in the listening history.
+
+    Vectors are appended to flat float32 files that are memory-mapped for queries. Exact queries scan all
+    vectors; approximate queries only scan the lists of the nearest k-means centroids (see build_approximate).
+    """
+
+    def __init__(self, db_loc: str, index_directory: str = "./data/index", engine: Optional[Engine] = None):
+        self.db_loc = db_loc
+        self.index_directory = index_directory
+        self.engine = engine
+        self._owns_engine = engine is None
+        self._features = None
+        self._norms = None
+        self._lists = None
+        self._centroids = None
+        self._isrcs = []
+        self._isrc_to_row = {}
+
+    def _get_engine(self):
+        if not self.engine:
+            self.engine = create_engine(self.db_loc)
+        return self.engine
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_directory, name)
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self._path("meta.json")):
+            return {"dim": FEATURE_DIM, "count": 0}
+        with open(self._path("meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta["dim"] != FEATURE_DIM:
+            raise ValueError(f"Index has dimension {meta['dim']}, expected {FEATURE_DIM}. Run rebuild().")
+        return meta
+
+    def _open(self) -> None:
+        """ Memory-map the index files. Only the first meta['count'] rows are used, anything after is a half-written update. """
+        count = self._read_meta()["count"]
+        self._features, self._norms, self._lists, self._centroids = None, None, None, None
+        self._isrcs, self._isrc_to_row = [], {}
+        if count == 0:
+            return
+        self._features = np.memmap(self._path("features.f32"), dtype="float32", mode="r", shape=(count, FEATURE_DIM))
+        self._norms = np.memmap(self._path("norms.f32"), dtype="float32", mode="r", shape=(count,))
+        with open(self._path("isrcs.txt"), "r") as f:
+            self._isrcs = f.read().splitlines()[:count]
+        self._isrc_to_row = {isrc: row for row, isrc in enumerate(self._isrcs)}
+        if os.path.exists(self._path("centroids.npy")):
+            self._centroids = np.load(self._path("centroids.npy"))
+            self._lists = np.memmap(self._path("lists.i32"), dtype="int32", mode="r", shape=(count,))
+
+    def _append(self, name: str, data: bytes, offset: int) -> None:
+        mode = "r+b" if os.path.exists(self._path(name)) else "wb"
+        with open(self._path(name), mode) as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(data)
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """ Index of the nearest centroid for each vector, computed in chunks to keep memory bounded. """
+        centroid_norms = (self._centroids ** 2).sum(axis=1)
+        assignments = np.empty(len(vectors), dtype="int32")
+        for start in range(0, len(vectors), ASSIGN_CHUNK):
+            distances = vectors[start:start + ASSIGN_CHUNK] @ self._centroids.T
+            distances *= -2
+            distances += centroid_norms
+            assignments[start:start + ASSIGN_CHUNK] = distances.argmin(axis=1)
+        return assignments
+
+    def update(self) -> int:
+        """ Index rows of acousticbrainz_data inserted or updated since the last update. Returns the number of rows indexed.
+
+        Rows are found through the load_seq high-water mark stored in meta.json. Vectors of ISRCs that are
+        already indexed, e.g. after a low-level retry, are overwritten in place. Rows changed without bumping
+        load_seq, or a recreated acousticbrainz_data table, require rebuild().
+        """
+        try:
+            self.engine = self._get_engine()
+            os.makedirs(self.index_directory, exist_ok=True)
+            self._open()
+            meta = self._read_meta()
+            with self.engine.begin() as conn:
+                query_features = text("""
+                    SELECT ab.*
+                    FROM acousticbrainz_data ab
+                    WHERE ab.load_seq > :last_seq
+                    AND EXISTS (SELECT 1 FROM song_data s WHERE s.isrc = ab.isrc)
+                    ORDER BY ab.load_seq
+                """)
+                df = pd.read_sql(query_features, conn, params={"last_seq": meta.get("last_seq", -1)})
+            if df.empty:
+                print("Similarity index is up to date.")
+                return 0
+
+            vectors = _feature_matrix(df)
+            norms = (vectors ** 2).sum(axis=1).astype("float32")
+            known_rows = df["isrc"].map(self._isrc_to_row)
+            refreshed = known_rows.notna().to_numpy()
+
+            # refreshed rows are overwritten in place, writing them again after a crash is harmless
+            if refreshed.any():
+                rows = known_rows[refreshed].astype("int64").to_numpy()
+                count = len(self._isrcs)
+                features = np.memmap(self._path("features.f32"), dtype="float32", mode="r+", shape=(count, FEATURE_DIM))
+                features[rows] = vectors[refreshed]
+                features.flush()
+                stored_norms = np.memmap(self._path("norms.f32"), dtype="float32", mode="r+", shape=(count,))
+                stored_norms[rows] = norms[refreshed]
+                stored_norms.flush()
+                if self._centroids is not None:
+                    lists = np.memmap(self._path("lists.i32"), dtype="int32", mode="r+", shape=(count,))
+                    lists[rows] = self._assign(vectors[refreshed])
+                    lists.flush()
+                del features, stored_norms
+
+            new_isrcs = list(df.loc[~refreshed, "isrc"])
+            vectors, norms = vectors[~refreshed], norms[~refreshed]
+            count = len(self._isrcs)
+            isrcs_bytes = meta.get("isrcs_bytes", sum(len(isrc) + 1 for isrc in self._isrcs))
+            self._append("features.f32", vectors.tobytes(), count * FEATURE_DIM * 4)
+            self._append("norms.f32", norms.tobytes(), count * 4)
+            if self._centroids is not None:
+                self._append("lists.i32", self._assign(vectors).tobytes(), count * 4)
+            isrcs_data = "".join(f"{isrc}\n" for isrc in new_isrcs).encode()
+            self._append("isrcs.txt", isrcs_data, isrcs_bytes)
+
+            # meta is written last and atomically, it marks the update as complete
+            new_meta = {
+                "dim": FEATURE_DIM,
+                "count": count + len(new_isrcs),
+                "isrcs_bytes": isrcs_bytes + len(isrcs_data),
+                "last_seq": int(df["load_seq"].max())
+            }
+            with open(self._path("meta.json.tmp"), "w") as f:
+                json.dump(new_meta, f)
+            os.replace(self._path("meta.json.tmp"), self._path("meta.json"))
+
+            self._open()
+            print(f"Added {len(new_isrcs)} and refreshed {int(refreshed.sum())} tracks in the similarity index, {len(self._isrcs)} in total.")
+            return len(df)
+        except Exception as e:
+            print(f"Similarity index update failed: {e}")
+            return 0
+        finally:
+            if self._owns_engine and self.engine is not None:
+                self.engine.dispose()
+
+    def rebuild(self) -> int:
+        """ Drop the index files and index every track again. """
+        for name in ("meta.json", "meta.json.tmp", "features.f32", "norms.f32", "isrcs.txt", "centroids.npy", "lists.i32"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        return self.update()
+
+    def build_approximate(self, n_lists: int = 1024, iterations: int = 10, sample_size: int = 100_000, seed: int = 0) -> None:
+        """ Train k-means centroids on a sample of the vectors and assign every vector to its nearest centroid. """
+        self._open()
+        count = len(self._isrcs)
+        if count == 0:
+            print("Similarity index is empty, nothing to train on.")
+            return
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self._features[np.sort(rng.choice(count, size=min(sample_size, count), replace=False))])
+        n_lists = min(n_lists, len(sample))
+        self._centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(sample)
+            order = np.argsort(assignments, kind="stable")
+            filled, starts, sizes = np.unique(assignments[order], return_index=True, return_counts=True)
+            self._centroids[filled] = np.add.reduceat(sample[order], starts, axis=0) / sizes[:, None]
+
+        lists = np.concatenate([self._assign(np.asarray(self._features[start:start + SCAN_BLOCK]))
+                                for start in range(0, count, SCAN_BLOCK)])
+        np.save(self._path("centroids.npy"), self._centroids)
+        with open(self._path("lists.i32"), "wb") as f:
+            f.write(lists.tobytes())
+        self._open()
+        print(f"Built approximate index with {n_lists} lists over {count} tracks.")
+
+    def _search(self, query: np.ndarray, k: int, exclude: set[int], approximate: bool, n_probe: int) -> tuple[np.ndarray, np.ndarray]:
+        """ Rows and squared distances of the k nearest vectors, closest first. """
+        count = len(self._isrcs)
+        if approximate and self._centroids is not None:
+            probe = np.argsort(((self._centroids - query) ** 2).sum(axis=1))[:n_probe]
+            candidates = np.flatnonzero(np.isin(self._lists, probe))
+        else:
+            candidates = None
+
+        rows_list, distances_list = [], []
+        blocks = [candidates] if candidates is not None else [np.arange(start, min(start + SCAN_BLOCK, count))
+                                                              for start in range(0, count, SCAN_BLOCK)]
+        for rows in blocks:
+            if candidates is None:
+                vectors, norms = self._features[rows[0]:rows[-1] + 1], self._norms[rows[0]:rows[-1] + 1]
+            else:
+                vectors, norms = self._features[rows], self._norms[rows]
+            distances = norms - 2 * (vectors @ query) + query @ query
+            top = min(k + len(exclude), len(rows))
+            best = np.argpartition(distances, top - 1)[:top] if top < len(rows) else np.arange(len(rows))
+            rows_list.append(rows[best])
+            distances_list.append(distances[best])
+
+        rows = np.concatenate(rows_list)
+        distances = np.concatenate(distances_list)
+        keep = ~np.isin(rows, list(exclude))
+        rows, distances = rows[keep], distances[keep]
+        order = np.argsort(distances)[:k]
+        return rows[order], np.maximum(distances[order], 0)
+
+    def _describe(self, isrcs: list[str], distances: np.ndarray) -> pd.DataFrame:
+        """ Attach song and artist names to the matched ISRCs. """
+        with self._get_engine().begin() as conn:
+            query = text("""
+                SELECT DISTINCT ON (s.isrc) s.isrc, s.track_id, s.song_name, a.artist_name, s.spotify_url
+                FROM song_data s
+                LEFT JOIN artist_data a ON s.artist_id = a.artist_id
+                WHERE s.isrc = ANY(:isrcs)
+            """)
+            songs = pd.read_sql(query, conn, params={"isrcs": isrcs})
+        df = pd.DataFrame({"isrc": isrcs, "distance": np.sqrt(distances)})
+        return df.merge(songs, on="isrc", how="left")
+
+    def _track_isrcs(self, track_ids: list[str]) -> list[str]:
+        with self._get_engine().begin() as conn:
+            query = text("""
+                SELECT DISTINCT isrc
+                FROM song_data
+                WHERE track_id = ANY(:track_ids)
+                AND isrc IS NOT NULL
+            """)
+            return [row.isrc for row in conn.execute(query, {"track_ids": track_ids})]
+
+    def query_tracks(self, track_ids: list[str], k: int = 10, approximate: bool = False, n_probe: int = 8) -> pd.DataFrame:
+        """ Tracks closest to the mean feature vector of the given Spotify tracks, e.g. a single track or a listening session. """
+        if self._features is None:
+            self._open()
+        rows = [self._isrc_to_row[isrc] for isrc in self._track_isrcs(track_ids) if isrc in self._isrc_to_row]
+        if not rows:
+            print("None of the given tracks are in the similarity index.")
+            return pd.DataFrame()
+        query = np.asarray(self._features[sorted(rows)]).mean(axis=0)
+        found, distances = self._search(query, k, set(rows), approximate, n_probe)
+        return self._describe([self._isrcs[row] for row in found], distances)
+
+    def query_plays(self, start: str, end: str, user_id: Optional[str] = None, k: int = 10,
+                    approximate: bool = False, n_probe: int = 8) -> pd.DataFrame:
+        """ Tracks closest to what was played between start and end (ISO8601), optionally for one user only. """
+        with self._get_engine().begin() as conn:
+            query = text("""
+                SELECT DISTINCT track_id
+                FROM plays
+                WHERE played_at::timestamptz >= CAST(:start AS timestamptz)
+                AND played_at::timestamptz < CAST(:end AS timestamptz)
+                AND (CAST(:user_id AS TEXT) IS NULL OR user_id = :user_id)
+            """)
+            track_ids = [row.track_id for row in conn.execute(query, {"start": start, "end": end, "user_id": user_id})]
+        return self.query_tracks(track_ids, k=k, approximate=approximate, n_probe=n_probe)
+
+
+def run(db_loc: str, engine: Optional[Engine] = None) -> None:
+    index = SimilarityIndex(db_loc=db_loc, engine=engine)
+    index.update()
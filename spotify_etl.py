@@ -1,5 +1,8 @@
 from sqlalchemy import create_engine, exc, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.engine import Engine
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import webbrowser
@@ -8,21 +11,66 @@ import datetime
 from typing import Any, Optional
 import pandas as pd
 import localserver
+from sessionizer import Sessionizer
+
+
+DEFAULT_USER_ID = "default"
+
+
+def _insert_do_nothing(table, conn, keys, data_iter) -> int:
+    """ pandas to_sql method, skips rows whose primary key already exists (shared tables across users).
+
+    Returns the number of rows actually inserted, which to_sql sums over chunks.
+    """
+    rows = [dict(zip(keys, row)) for row in data_iter]
+    if not rows:
+        return 0
+    stmt = insert(table.table).values(rows).on_conflict_do_nothing()
+    return conn.execute(stmt).rowcount
+
+
+class ArtistClaims:
+    """ Thread-safe register of artist IDs already fetched from Spotify during a multi-user run. """
+
+    def __init__(self):
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    def claim(self, artist_ids: list[str]) -> list[str]:
+        """ Return the IDs not claimed by another pipeline yet, and mark them as claimed. """
+        with self._lock:
+            new_ids = [id for id in artist_ids if id not in self._claimed]
+            self._claimed.update(new_ids)
+            return new_ids
+
+    def release(self, artist_ids: list[str]) -> None:
+        """ Give up claims for artists whose fetch or load failed, so they can be fetched again. """
+        with self._lock:
+            self._claimed.difference_update(artist_ids)
 
 
 class SpotifyETL:
-    def __init__(self, db_loc: str, client_id: str, client_secret: str, redirect_uri: str):
+    def __init__(self, db_loc: str, client_id: str, client_secret: str, redirect_uri: str,
+                 user_id: str = DEFAULT_USER_ID, engine: Optional[Engine] = None, artist_claims: Optional[ArtistClaims] = None,
+                 session_gap_minutes: int = 30, skip_ratio: float = 0.8):
 
         self.db_loc = db_loc
         self.client_id = client_id
         self.client_secret = client_secret
         self.redirect_uri = redirect_uri
+        self.user_id = user_id
         self.sp_client = None
-        self.engine = None
-        self.token_cache_path = "spotify_token_cache.json"
+        self.engine = engine
+        self._owns_engine = engine is None
+        self.artist_claims = artist_claims
+        self.sessionizer = Sessionizer(gap_minutes=session_gap_minutes, skip_ratio=skip_ratio)
+        if user_id == DEFAULT_USER_ID:
+            self.token_cache_path = "spotify_token_cache.json"
+        else:
+            self.token_cache_path = f"spotify_token_cache_{user_id}.json"
 
     def _get_engine(self):
-        if not self.engine or self.engine.closed:
+        if not self.engine:
             self.engine = create_engine(self.db_loc)
         return self.engine
 
@@ -32,7 +80,8 @@ class SpotifyETL:
             client_secret=self.client_secret,
             redirect_uri=self.redirect_uri,
             scope="user-read-recently-played",
-            cache_path=self.token_cache_path
+            cache_path=self.token_cache_path,
+            show_dialog=self.user_id != DEFAULT_USER_ID  # let each team member log in with their own account
         )
 
         token_info = auth_manager.get_cached_token()
@@ -63,12 +112,15 @@ class SpotifyETL:
 
         with self.engine.begin() as conn:
             query1 = text("""
-                CREATE TABLE IF NOT EXISTS plays (       
-                    played_at TEXT PRIMARY KEY,
-                    track_id TEXT
+                CREATE TABLE IF NOT EXISTS plays (
+                    user_id TEXT NOT NULL DEFAULT 'default',
+                    played_at TEXT,
+                    track_id TEXT,
+                    PRIMARY KEY (user_id, played_at)
                 )
             """)
             conn.execute(query1)
+            self._migrate_plays(conn)
             query2 = text(""" 
                 CREATE TABLE IF NOT EXISTS song_data (       
                     track_id TEXT PRIMARY KEY,
@@ -100,10 +152,66 @@ class SpotifyETL:
                 ) 
             """)
             conn.execute(query4)
+            self.sessionizer.initialize(conn)
+
+    def _migrate_plays(self, conn) -> None:
+        """ Add the user_id dimension to a plays table created before multi-user support. """
+        query = text("""
+            SELECT column_name
+            FROM information_schema.key_column_usage
+            WHERE table_schema = current_schema()
+            AND table_name = 'plays'
+            AND constraint_name = 'plays_pkey'
+        """)
+        pkey_columns = {row.column_name for row in conn.execute(query)}
+        if "user_id" in pkey_columns:
+            return
+        conn.execute(text("ALTER TABLE plays ADD COLUMN IF NOT EXISTS user_id TEXT NOT NULL DEFAULT 'default'"))
+        conn.execute(text("ALTER TABLE plays DROP CONSTRAINT IF EXISTS plays_pkey"))
+        conn.execute(text("ALTER TABLE plays ADD CONSTRAINT plays_pkey PRIMARY KEY (user_id, played_at)"))
+        print("Migrated plays table to include user_id.")
+
+    def _get_unknown_artist_ids(self, artist_ids: list[str]) -> list[str]:
+        """ Artist IDs not yet in artist_data, and not already being fetched by another user's pipeline.
+
+        artist_data only holds artists that were fetched successfully, so artists of earlier songs whose
+        fetch failed are included as well and retried.
+        """
+        with self.engine.begin() as conn:
+            query = text("""
+                SELECT DISTINCT s.artist_id
+                FROM song_data s
+                LEFT JOIN artist_data a ON s.artist_id = a.artist_id
+                WHERE a.artist_id IS NULL
+                AND s.artist_id <> ''
+                UNION
+                SELECT ids.artist_id
+                FROM unnest(CAST(:artist_ids AS TEXT[])) AS ids(artist_id)
+                LEFT JOIN artist_data a ON ids.artist_id = a.artist_id
+                WHERE a.artist_id IS NULL
+            """)
+            res = conn.execute(query, {"artist_ids": artist_ids})
+            unknown_ids = sorted(row.artist_id for row in res)
+        if self.artist_claims is not None:
+            unknown_ids = self.artist_claims.claim(unknown_ids)
+        return unknown_ids
 
-    def _transform(self, raw_data: dict[str, Any]) -> pd.DataFrame:
+    def _fetch_artists(self, artist_ids: list[str]) -> dict[str, dict]:
+        """ Fetch artist information, 50 IDs per request. Claims of artists that could not be fetched are released. """
         sp = self._get_spotify_client()
+        artist_info_dict = {}
+        try:
+            for i in range(0, len(artist_ids), 50):
+                artist_info_list = sp.artists(artist_ids[i:i + 50])["artists"]
+                artist_info_dict.update({artist["id"]: artist for artist in artist_info_list if artist})
+        except spotipy.exceptions.SpotifyException as e:
+            print(f"Error fetching artist information: {e}")
+        finally:
+            if self.artist_claims is not None:
+                self.artist_claims.release([id for id in artist_ids if id not in artist_info_dict])
+        return artist_info_dict
 
+    def _transform(self, raw_data: dict[str, Any]) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
         song_name_list, artist_name_list, featured_artist_list = [], [], []
         genre_list, album_name_list = [], []
         duration_list, release_date_list, played_at_list = [], [], []
@@ -132,21 +240,16 @@ class SpotifyETL:
             featured_artist_list.append(", ".join(artist_names[1:]) if len(artist_names) > 1 else "")
             artist_id_list.append(artists[0].get("id") if artists else "")
 
-        unique_artist_ids = [id for id in set(artist_id_list) if id]
-        try:
-            artist_info_list = sp.artists(unique_artist_ids)["artists"]
-            artist_info_dict = {artist["id"]: artist for artist in artist_info_list}
-        except spotipy.exceptions.SpotifyException as e:
-            print(f"Error fetching artist information: {e}")
-            artist_info_dict = {}
+        # only fetch artists that are new to the shared artist tables
+        unique_artist_ids = self._get_unknown_artist_ids([id for id in set(artist_id_list) if id])
+        artist_info_dict = self._fetch_artists(unique_artist_ids) if unique_artist_ids else {}
 
         genres_dict = {}
-        for id in artist_id_list:
-            artist_info = artist_info_dict.get(id)
-            genres = artist_info.get("genres", [])
-            genres_dict[id] = genres
+        for id, artist_info in artist_info_dict.items():
+            genres_dict[id] = artist_info.get("genres", [])
 
         df = pd.DataFrame({
+            "user_id": self.user_id,
             "played_at": played_at_list,
             "song_name": song_name_list,
             "artist_name": artist_name_list,
@@ -159,9 +262,12 @@ class SpotifyETL:
             "spotify_url": spotify_url_list,
             "isrc": isrc_list
         })
+        # artist rows are only written for successfully fetched artists, the others are fetched again next run
+        artists_df = pd.DataFrame([(id, info.get("name"), ", ".join(genres_dict[id])) for id, info in artist_info_dict.items()],
+                                  columns=['artist_id', 'artist_name', 'artist_genre'])
         genres_df = pd.DataFrame([(artist_id, genre) for artist_id, genres in genres_dict.items() for genre in genres],
                                  columns=['artist_id', 'genre'])
-        return df, genres_df
+        return df, artists_df, genres_df
 
     def _validate_data(self, df: pd.DataFrame) -> bool:
         """ Quick data validation before uploading to database. """
@@ -176,94 +282,174 @@ class SpotifyETL:
 
         return True
 
-    def _load(self, df: pd.DataFrame, genres_df: pd.DataFrame) -> None:
-        """Load processed data into database."""
-        if df.empty:
-            print("DataFrame is empty, no data to upload.")
-            return
+    def _load(self, df: pd.DataFrame, artists_df: pd.DataFrame, genres_df: pd.DataFrame) -> None:
+        """Load processed data into database.
+
+        The shared song, artist and genre tables are written first in their own short transaction, rows sorted
+        by primary key, so concurrent pipelines lock shared rows in the same order and do not deadlock.
+        Plays and sessions, which only concern this user, follow in a second transaction.
+        """
         try:
+            # queries used in filtering dataframe before uploading
+            query_plays = text(""" 
+                SELECT played_at 
+                FROM plays 
+                WHERE user_id = :user_id
+                ORDER BY played_at DESC
+                LIMIT 1
+            """)
+            query_songs = text(""" 
+                SELECT track_id 
+                FROM song_data
+            """)
             with self.engine.begin() as conn:
-
-                # queries used in filtering dataframe before uploading
-                query_plays = text(""" 
-                    SELECT played_at 
-                    FROM plays 
-                    ORDER BY played_at DESC
-                    LIMIT 1
-                """)
-                query_songs = text(""" 
-                    SELECT track_id 
-                    FROM song_data
-                """)
-                query_artists = text(""" 
-                    SELECT artist_id 
-                    FROM artist_data
-                """)
-                query_genres = text(""" 
-                    SELECT artist_id, genre 
-                    FROM genres
-                """)
                 # Filter on timestamp, in ISO8601 so converting to datetime for comparison
-                latest_uploaded_timestamp = conn.execute(query_plays).scalar()
+                latest_uploaded_timestamp = conn.execute(query_plays, {"user_id": self.user_id}).scalar()
+                uploaded_track_ids = {row.track_id for row in conn.execute(query_songs)}
+            new_df = df
+            if not df.empty:
                 df['datetime'] = pd.to_datetime(df['played_at'], format="ISO8601")
                 if latest_uploaded_timestamp:
                     latest_uploaded_timestamp_dt = pd.to_datetime(latest_uploaded_timestamp, format="ISO8601")
                     new_df = df[df['datetime'] > latest_uploaded_timestamp_dt]
-                else:
-                    new_df = df
                 new_df = new_df.sort_values(by="datetime", ascending=True)
 
-                if not self._validate_data(new_df):
-                    print("Data did not pass validation when uploading plays.")
-                    return
-                new_df[['played_at', 'track_id']].to_sql('plays', self.engine, index=False, if_exists='append')
-
-                number_of_plays = len(new_df)
-                # Filter songs
-                res = conn.execute(query_songs)
-                uploaded_track_ids = {row.track_id for row in res}
-                new_df = new_df[~new_df['track_id'].isin(uploaded_track_ids)]
-                new_df = new_df.drop_duplicates(subset='track_id', keep='first')
-                new_df[['track_id', 'song_name', 'featured_artists',
-                        'album_name', 'release_date', 'duration_sec',
-                        'artist_id', 'spotify_url', 'isrc']].to_sql('song_data', self.engine, index=False, if_exists='append')
-                number_of_new_songs = len(new_df)
-                # Filter artists
-                res = conn.execute(query_artists)
-                uploaded_artist_ids = {row.artist_id for row in res}
-                new_df = new_df[~new_df['artist_id'].isin(uploaded_artist_ids)]
-                new_df = new_df.drop_duplicates(subset='artist_id', keep='first')
-                new_df[['artist_id', 'artist_name']].to_sql('artist_data', self.engine, index=False, if_exists='append')
-                number_of_new_artists = len(new_df)
-
-                # Filter genres
-                existing_genres = pd.read_sql(query_genres, conn)
-                filtered_genres_df = genres_df[~genres_df.apply(tuple, 1).isin(existing_genres.apply(tuple, 1))]
-                filtered_genres_df.to_sql('genres', self.engine, index=False, if_exists='append')
-                number_of_genres = len(filtered_genres_df)
-
-                print(
-                    f"Data loaded successfully for {number_of_plays} plays. Played {number_of_new_songs} new songs and listened to {number_of_new_artists} new artists. Added {number_of_genres} new genres.")
+            # Filter songs
+            songs_df = new_df[~new_df['track_id'].isin(uploaded_track_ids)] if not new_df.empty else new_df
+            songs_df = songs_df.drop_duplicates(subset='track_id', keep='first').sort_values(by='track_id')
+            artists_df = artists_df.sort_values(by='artist_id')
+            genres_df = genres_df.drop_duplicates().sort_values(by=['artist_id', 'genre'])
 
+            number_of_new_songs = number_of_new_artists = number_of_genres = 0
+            with self.engine.begin() as conn:
+                if not songs_df.empty:
+                    number_of_new_songs = songs_df[['track_id', 'song_name', 'featured_artists',
+                                                    'album_name', 'release_date', 'duration_sec',
+                                                    'artist_id', 'spotify_url', 'isrc']].to_sql('song_data', conn, index=False, if_exists='append',
+                                                                                                method=_insert_do_nothing) or 0
+                # Artists, only the ones fetched in this run
+                if not artists_df.empty:
+                    number_of_new_artists = artists_df.to_sql('artist_data', conn, index=False, if_exists='append',
+                                                              method=_insert_do_nothing) or 0
+                # Genres, only artists fetched in this run have genres
+                if not genres_df.empty:
+                    number_of_genres = genres_df.to_sql('genres', conn, index=False, if_exists='append',
+                                                        method=_insert_do_nothing) or 0
         except Exception as e:
             print(f"Failed to upload to database. Error: {e}")
+            if self.artist_claims is not None:
+                self.artist_claims.release(list(artists_df['artist_id']))
+            return
+
+        has_new_plays = self._validate_data(new_df)
+        if not has_new_plays:
+            print("Data did not pass validation when uploading plays.")
+        try:
+            with self.engine.begin() as conn:
+                number_of_plays = 0
+                if has_new_plays:
+                    new_df[['user_id', 'played_at', 'track_id']].to_sql('plays', conn, index=False, if_exists='append')
+                    number_of_plays = len(new_df)
+
+                # sessions are updated after song_data is committed, so a first-time backfill finds the durations of new songs.
+                # Runs without new plays too, a user with history but no sessions yet is backfilled.
+                number_of_sessions = self.sessionizer.update(conn, self.user_id, new_df)
+
+            if not has_new_plays:
+                if number_of_sessions:
+                    print(f"[{self.user_id}] Backfilled {number_of_sessions} listening sessions.")
+                return
+            print(
+                f"[{self.user_id}] Data loaded successfully for {number_of_plays} plays. Played {number_of_new_songs} new songs and listened to {number_of_new_artists} new artists. Added {number_of_genres} new genres. Updated {number_of_sessions} listening sessions.")
+
+        except Exception as e:
+            print(f"Failed to upload to database. Error: {e}")
+
+    def _run_steps(self) -> None:
+        """ Extract, transform and load for this user, on an engine and tables that are already set up. """
+        raw_data = self._extract()
+        processed_data, artists_df, genres_df = self._transform(raw_data)
+        self._load(processed_data, artists_df, genres_df)
 
     def run(self) -> None:
         """Run the complete ETL pipeline."""
         try:
             self.engine = self._get_engine()
             self._initialize_database()
-            raw_data = self._extract()
-            processed_data, genres_dict = self._transform(raw_data)
-            self._load(processed_data, genres_dict)
+            self._run_steps()
             # return processed_data
         except Exception as e:
             print(f"ETL pipeline failed: {e}")
             return None
         finally:
-            self.engine.dispose()
+            if self._owns_engine and self.engine is not None:
+                self.engine.dispose()
+
+
+class MultiUserSpotifyETL:
+    """ Runs one SpotifyETL per user concurrently, sharing a single connection pool. """
+
+    def __init__(self, db_loc: str, client_id: str, client_secret: str, redirect_uri: str,
+                 user_ids: list[str], max_workers: int = 4, session_gap_minutes: int = 30, skip_ratio: float = 0.8):
+        self.db_loc = db_loc
+        self.user_ids = list(dict.fromkeys(user_ids))
+        self.max_workers = max(1, min(max_workers, len(self.user_ids)))
+        self.engine = None
+        self.artist_claims = ArtistClaims()
+        self.etl_kwargs = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "redirect_uri": redirect_uri,
+            "session_gap_minutes": session_gap_minutes,
+            "skip_ratio": skip_ratio
+        }
+
+    def _get_engine(self):
+        if not self.engine:
+            self.engine = create_engine(self.db_loc, pool_size=self.max_workers, max_overflow=0)
+        return self.engine
+
+    def run(self) -> None:
+        """Run the ETL pipeline for every user."""
+        if not self.user_ids:
+            print("No users to ingest.")
+            return
+        try:
+            self.engine = self._get_engine()
+            pipelines = [SpotifyETL(db_loc=self.db_loc, user_id=user_id, engine=self.engine,
+                                    artist_claims=self.artist_claims, **self.etl_kwargs)
+                         for user_id in self.user_ids]
+            pipelines[0]._initialize_database()
+
+            # authentication may need the browser and the local redirect server, so it is done one user at a time
+            for etl in pipelines:
+                etl._get_spotify_client()
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(etl._run_steps): etl.user_id for etl in pipelines}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"ETL pipeline failed for user {futures[future]}: {e}")
+        except Exception as e:
+            print(f"Multi-user ETL pipeline failed: {e}")
+            return None
+        finally:
+            if self.engine is not None:
+                self.engine.dispose()
+
+
+def run(db_loc: str, client_id: str, client_secret: str, redirect_uri: str,
+        session_gap_minutes: int = 30, skip_ratio: float = 0.8) -> None:
+    etl = SpotifyETL(db_loc=db_loc, client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri,
+                     session_gap_minutes=session_gap_minutes, skip_ratio=skip_ratio)
+    etl.run()
 
 
-def run(db_loc: str, client_id: str, client_secret: str, redirect_uri: str) -> None:
-    etl = SpotifyETL(db_loc=db_loc, client_id=client_id, client_secret=client_secret, redirect_uri=redirect_uri)
+def run_many(db_loc: str, client_id: str, client_secret: str, redirect_uri: str, user_ids: list[str], max_workers: int = 4,
+             session_gap_minutes: int = 30, skip_ratio: float = 0.8) -> None:
+    etl = MultiUserSpotifyETL(db_loc=db_loc, client_id=client_id, client_secret=client_secret,
+                              redirect_uri=redirect_uri, user_ids=user_ids, max_workers=max_workers,
+                              session_gap_minutes=session_gap_minutes, skip_ratio=skip_ratio)
     etl.run()
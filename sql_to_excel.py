@@ -5,6 +5,10 @@ from datetime import datetime
 import os
 
 
+# local time zone of the exports, the hourly sheet shifts UTC hours to CET as well
+LOCAL_TIMEZONE = "CET"
+
+
 class DatabaseToExcelExtraction:
     def __init__(self, db_loc: str):
         self.db_loc = db_loc
@@ -25,19 +29,13 @@ class DatabaseToExcelExtraction:
             query1 = text("""
             SELECT
                 EXTRACT(HOUR FROM p.played_at::timestamp) AS hour_of_day,
+                -- same definitions as with the former TEXT labels: share of tracks labelled danceable/bright,
+                -- and the winning gender probability, positive for male and negative for female
+                ROUND(AVG(CASE WHEN ab.danceability > 0.5 THEN 1 ELSE 0 END)::numeric, 2) AS danceability_score,
+                ROUND(AVG(CASE WHEN ab.bright > 0.5 THEN 1 ELSE 0 END)::numeric, 2) AS brightness_score,
                 ROUND(AVG(CASE
-                            WHEN ab.danceability = 'danceable' THEN 1
-                            WHEN ab.danceability = 'not_danceable' THEN 0
-                            ELSE 0.5
-                                END)::numeric, 2) AS danceability_score,
-                ROUND(AVG(CASE
-                            WHEN ab.timbre = 'bright' THEN 1
-                            WHEN ab.timbre = 'dark' then 0
-                            ELSE 0.5
-                        END)::numeric, 2) AS brightness_score,
-                ROUND(AVG(CASE
-                            WHEN ab.gender = 'male' THEN ab.gender_prob
-                            WHEN ab.gender = 'female' then -ab.gender_prob
+                            WHEN ab.female > 0.5 THEN -ab.female
+                            WHEN ab.female IS NOT NULL THEN 1 - ab.female
                             ELSE 0
                         END)::numeric, 2) AS male_score,
                 COUNT(*) as entries
@@ -45,7 +43,7 @@ class DatabaseToExcelExtraction:
             JOIN song_data s ON p.track_id = s.track_id
             JOIN acousticbrainz_data ab ON s.isrc = ab.isrc
             WHERE ab.danceability IS NOT NULL
-            AND ab.timbre IS NOT NULL
+            AND ab.bright IS NOT NULL
             GROUP BY hour_of_day
             ORDER BY hour_of_day
             """)
@@ -89,7 +87,7 @@ class DatabaseToExcelExtraction:
                 JOIN song_data s ON p.track_id = s.track_id
                 JOIN acousticbrainz_data ab ON s.isrc = ab.isrc
                 WHERE ab.danceability IS NOT NULL
-                AND ab.timbre IS NOT NULL
+                AND ab.bright IS NOT NULL
                 GROUP BY weekday
                 ORDER BY weekday
             """)
@@ -101,12 +99,15 @@ class DatabaseToExcelExtraction:
     def _create_large_sheet(self):
         with self._engine.begin() as conn:
             query = text(""" 
-                SELECT  p.played_at, p.track_id,
+                SELECT  p.user_id, p.played_at, p.track_id,
                         s.song_name, s.featured_artists, s.album_name,
                         s.release_date, s.duration_sec, s.artist_id, s.spotify_url, s.isrc,
                         a.artist_name, a.artist_genre,
-                        ab.mbid, ab.danceability, ab.instrumentality, ab.instrumentality_prob, ab.gender,
-                        ab.gender_prob, ab.timbre, ab.tonality
+                        ab.mbid, ab.danceability, ab.female, ab.instrumental, ab.bright, ab.tonal,
+                        ab.mood_acoustic, ab.mood_aggressive, ab.mood_electronic, ab.mood_happy,
+                        ab.mood_party, ab.mood_relaxed, ab.mood_sad,
+                        ab.genre_dortmund, ab.genre_electronic, ab.genre_rosamerica, ab.genre_tzanetakis,
+                        ab.ismir04_rhythm, ab.moods_mirex, ab.bpm, ab.key, ab.mode
                 FROM plays p
                 JOIN song_data s ON p.track_id = s.track_id
                 JOIN artist_data a ON s.artist_id = a.artist_id
@@ -117,6 +118,32 @@ class DatabaseToExcelExtraction:
             output_path = self._generate_output_path(table_name)
             df.to_excel(output_path)
 
+    def _create_sessions_sheet(self):
+        with self._engine.begin() as conn:
+            query = text("""
+                SELECT  user_id, session_start, session_end, session_length_sec, listened_sec, plays, skips,
+                        ROUND(skips::numeric / NULLIF(plays, 0), 2) AS skip_rate
+                FROM sessions
+                ORDER BY user_id, session_start
+            """)
+            df = pd.read_sql(query, conn)
+        if df.empty:
+            print("No listening sessions in the database, skipping sessions sheet.")
+            return
+        # psycopg2 returns the session time zone, mixed offsets around DST changes would leave object columns
+        for column in ('session_start', 'session_end'):
+            df[column] = pd.to_datetime(df[column], utc=True).dt.tz_convert(LOCAL_TIMEZONE).dt.tz_localize(None)
+
+        # listening streaks, consecutive local days with at least one session
+        days = df.assign(day=df['session_start'].dt.normalize())[['user_id', 'day']].drop_duplicates()
+        days['streak'] = days.groupby('user_id')['day'].diff().dt.days.ne(1).groupby(days['user_id']).cumsum()
+        streaks = days.groupby(['user_id', 'streak'])['day'].agg(streak_start='min', streak_end='max', days='count').reset_index()
+        streaks = streaks.drop(columns='streak').sort_values(['user_id', 'streak_start'])
+
+        for table_name, table in (("sessions", df), ("listening_streaks", streaks)):
+            output_path = self._generate_output_path(table_name)
+            table.to_excel(output_path, index=False)
+
     def run(self):
         """ Run the extraction, gathering data from database tables and creating excel spreadsheets for analysis purposes. """
         try:
@@ -124,6 +151,7 @@ class DatabaseToExcelExtraction:
             os.makedirs(self.output_directory, exist_ok=True)
             self._create_hourly_sheet()
             self._create_large_sheet()
+            self._create_sessions_sheet()
         except Exception as e:
             print(f"Database to excel-extraction failed: {e}")
             return None